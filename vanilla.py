@@ -14,24 +14,46 @@ import os
 import re
 import sys
 import time
+import zlib
 import json
+import base64
+import mmap
+import types
+import struct
+import random
+import atexit
 import socket
+import hashlib
 import mimetypes
 
-from copy import deepcopy
-from threading import local
+from copy import copy, deepcopy
+from threading import local, Lock, Thread, Event, Condition, \
+                        current_thread
 from traceback import format_exc
+from collections import deque
+from io import BytesIO
 
 try:                # Py2
     import httplib
     import __builtin__ as builtins
     from inspect import getargspec as getfullargspec
     from urlparse import parse_qs
+    from urllib import urlencode
 except ImportError: # Py3
     import http.client as httplib
     import builtins
     from inspect import getfullargspec
-    from urllib.parse import parse_qs
+    from urllib.parse import parse_qs, urlencode
+
+try:                # Py3 or Py2 with `futures` backport
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:                # Py3.4+
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 
 ## Compatible issues ##
@@ -39,6 +61,12 @@ if "unicode" not in dir(builtins):
     unicode = str
 else:
     bytes   = str
+
+# Py2 mmap doesn't support memoryview, static bundle use `buffer` there.
+if "buffer" in dir(builtins):
+    _BUFFER_TYPES = (memoryview, buffer)
+else:
+    _BUFFER_TYPES = (memoryview,)
        
 
 ## Http ##
@@ -49,6 +77,13 @@ _HTTP_STATUS = deepcopy(httplib.responses)
 _HTTP_ERROR_PAGE_CONTENT = "<html><title>oops</title>" \
                             "<body>Http Error occurred</body></html>"
 
+# Batch request environ not inherited by sub-requests.
+_BATCH_STRIP_ENVIRON = ("wsgi.file_wrapper", "CONTENT_TYPE", 
+                            "HTTP_ACCEPT_ENCODING", "HTTP_RANGE", 
+                            "HTTP_IF_RANGE", "HTTP_IF_MATCH", 
+                            "HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE",
+                            "HTTP_IF_UNMODIFIED_SINCE")
+
 
 ## Helper ##
 def _errno():
@@ -74,6 +109,16 @@ def b2u(string, encoding="utf8", errors="strict"):
         return string
 
 
+def _encode_stream(stream):
+    """ Encode chunks of a streaming response, close the stream when 
+            the server closes us (e.g.: client disconnected). """
+    try:
+        for chunk in stream:
+            yield u2b(chunk)
+    finally:
+        stream.close()
+
+
 ## Exception ##
 class VanillaError(Exception):
     """ Base Exception for everything. """
@@ -125,8 +170,23 @@ class Engine(object):
                         appStatic="static", 
                         appTemplate="templates",
                         appTemplateAdapter=None,
-                        appTemplateAdapterOptions=dict()):
-        """ Init new App instance. """
+                        appTemplateAdapterOptions=dict(),
+                        appAccessLog=None,
+                        appAccessLogOptions=dict(),
+                        appStaticBundle=None,
+                        appDeadline=None,
+                        appDeadlineWorkers=64):
+        """ Init new App instance. 
+        
+            `appDeadline`, seconds a request may take before a fast `504`
+                is answered, None (the default) means no deadline, routes
+                may override it with the `deadline` rule option.
+            `appDeadlineWorkers`, size of the reused thread pool which 
+                execute requests with deadline, abandoned work holds its
+                worker until it returns. This is not a concurrency limit,
+                when the pool is full requests run on their own thread 
+                and only post-processors and error pages respect the 
+                deadline, use `Engine.limit` to shed load. """
 
         self.name        = appName
         self.prefix      = appPrefix
@@ -138,6 +198,22 @@ class Engine(object):
         self.content     = HttpContext()
         self.router      = RequestRouter()
         self.err_handler = dict()
+        self.access_log  = None
+        self.limiters    = dict()
+        self.flights     = dict()
+        self.flight_lock = Lock()
+        self.flight_stat = {"shared": 0, "fallback": 0}
+        self.memprof     = None
+        self.bundle      = None
+        self.batch_pools = dict()
+
+        self.deadline      = appDeadline
+        self.deadline_miss = dict()
+        self.deadline_lock = Lock()
+
+        self.deadline_pool      = _WorkerPool(appDeadlineWorkers, 
+                                                "vanilla-deadline")
+        self.deadline_abandoned = 0
 
         self.request_preprocessor = list()
         self.request_postprocessor = list()
@@ -156,6 +232,15 @@ class Engine(object):
             self.tpl     = appTemplateAdapter(dirs=self.template, 
                                                 **appTemplateAdapterOptions)
 
+        if appAccessLog:
+            if not os.path.isabs(appAccessLog):
+                appAccessLog = os.path.join(self.prefix, appAccessLog)
+            self.access_log = AccessLogger(appAccessLog, 
+                                                **appAccessLogOptions)
+
+        if appStaticBundle:
+            self.load_static_bundle(appStaticBundle)
+
     def __call__(self, environ, start_response):
         """ WSGI compatible callable object. """
         return self.wsgi(environ, start_response)
@@ -168,10 +253,31 @@ class Engine(object):
         """ Return the Http Content Object of this instance. """
         return self.content
 
+    def load_static_bundle(self, filepath):
+        """ Serve static files from a bundle built by `pack_static`.
+
+            Calling this again with a new archive swaps the bundle in 
+            place, requests already served from the old archive keep it
+            mapped until they finish. """
+
+        if not os.path.isabs(filepath):
+            filepath = os.path.join(self.prefix, filepath)
+
+        if self.bundle is None:
+            self.bundle = StaticBundle(filepath)
+        else:
+            self.bundle.load(filepath)
+        return self.bundle
+
     def ssfile(self, filepath, mime_type=None, prefix=None):
-        """ Static file sender. """
+        """ Static file sender. 
+        
+            If a static bundle is loaded (see `load_static_bundle`) and
+            no `prefix` is given, the file is served from the bundle. """
         
         if prefix is None:
+            if self.bundle is not None:
+                return self._ssbundle(filepath, mime_type)
             prefix = self.static
 
         filepath = os.path.join(prefix, filepath)
@@ -196,15 +302,48 @@ class Engine(object):
 
         return open(filepath, 'rb')
 
-    def route(self, regex, methods=["GET"], callback=None):
-        """ Insert new rule to Router. """
+    def _ssbundle(self, filepath, mime_type=None):
+        """ Static file sender, serve from the static bundle. """
+
+        request  = self.content.request
+        response = self.content.response
+
+        accept = request.environ.get("HTTP_ACCEPT_ENCODING", "")
+        entry  = self.bundle.lookup(filepath, _accept_gzip(accept))
+        if entry is None:
+            raise HttpError(404)
+
+        meta, encoding, etag, view = entry
+        if meta["gzip"] is not None:
+            response.set_header("Vary", "Accept-Encoding")
+        response.set_header("ETag", etag)
+        response.set_header("Last-Modified", 
+                                time.strftime("%a, %d %b %Y %H:%M:%S GMT", 
+                                                time.gmtime(meta["mtime"])))
+
+        if _etag_match(etag, request.environ.get("HTTP_IF_NONE_MATCH", "")):
+            response.set_status(304)
+            return ""
+
+        if encoding:
+            response.set_header("Content-Encoding", encoding)
+        response.set_header("Content-Type", mime_type or meta["mime"])
+        response.set_header("Content-Length", len(view))
+
+        return view
+
+    def route(self, regex, methods=["GET"], callback=None, **rule_options):
+        """ Insert new rule to Router. 
+        
+            Extra keyword arguments are rule options, see `RequestRule`
+            for the supported ones. """
 
         if callback is not None:
-            self.router.insert(methods, regex, callback)
+            self.router.insert(methods, regex, callback, **rule_options)
             return 0
 
         def _add_rule(callback):
-            self.router.insert(methods, regex, callback)
+            self.router.insert(methods, regex, callback, **rule_options)
 
         return _add_rule
 
@@ -251,6 +390,228 @@ class Engine(object):
             should't change that. """
         self.request_postprocessor.append(callback)
 
+    def limit(self, limit_class, max_inflight, queue_size=0, 
+                    queue_timeout=1.0, retry_after=1, **adaptive_options):
+        """ Setup admission control for a class of routes.
+
+            At most `max_inflight` requests of routes registered with
+            `limit=limit_class` run at once, `queue_size` more requests 
+            may wait up to `queue_timeout` seconds for a free slot, 
+            everything else get a fast `503` with `Retry-After` header.
+
+            Routes without `limit` option fall into the `default` class.
+            See `ConcurrencyLimiter` for the `adaptive_options`. """
+        
+        limiter = ConcurrencyLimiter(max_inflight, queue_size, 
+                                        queue_timeout, retry_after,
+                                        **adaptive_options)
+        self.limiters[limit_class] = limiter
+        return limiter
+
+    def memory_profile(self, sample_rate=0.01, admin_route=None, top=10,
+                            **admin_rule_options):
+        """ Enable per route memory allocation tracking.
+
+            A `sample_rate` fraction of requests is traced by `tracemalloc`
+            from `RequestRule.make_call` to the end of `_make_output`, see
+            `MemoryProfiler` for detail. When disabled (the default) the 
+            cost is one attribute check per request.
+
+            If `admin_route` is given, a route returning the `top` routes
+            report as json is registered at that regex. """
+
+        self.memprof = MemoryProfiler(sample_rate)
+
+        if admin_route is not None:
+            def _memory_report():
+                self.content.response.set_header("Content-Type", 
+                                                    "application/json")
+                return json.dumps(self.memprof.report(top))
+            self.route(admin_route, ["GET"], _memory_report, 
+                            **admin_rule_options)
+
+        return self.memprof
+
+    def memory_report(self, top=10):
+        """ Return the `top` routes by retained bytes, see 
+                `MemoryProfiler.report`. """
+        if self.memprof is None:
+            return list()
+        return self.memprof.report(top)
+
+    def metrics(self):
+        """ Return runtime metrics of this instance as python dict. """
+
+        metrics = dict()
+        if self.access_log is not None:
+            metrics["access_log"] = self.access_log.stats()
+
+        with self.flight_lock:
+            metrics["coalescing"] = dict(self.flight_stat, 
+                                            inflight=len(self.flights))
+
+        if self.memprof is not None:
+            metrics["memory"] = self.memprof.report()
+
+        with self.deadline_lock:
+            metrics["deadline_miss"] = dict(self.deadline_miss)
+            metrics["deadline_workers"] = self.deadline_pool.busy
+            metrics["deadline_abandoned"] = self.deadline_abandoned
+
+        metrics["batch"] = dict()
+        for regex, pool in self.batch_pools.items():
+            metrics["batch"][regex] = pool.stats()
+
+        metrics["limiters"] = dict()
+        for limit_class, limiter in self.limiters.items():
+            metrics["limiters"][limit_class] = limiter.stats()
+
+        return metrics
+
+    def batch_route(self, regex, methods=["POST"], max_size=20, 
+                        timeout=10.0, workers=8, **rule_options):
+        """ Register a batch route.
+
+            The request body should be a json list of sub-requests, each
+            one is an object with `method`, `path`, optional `query` (str 
+            or object), `body` (str or json value) and `content_type`. 
+            Every sub-request is dispatched through the router with its
+            own http context (hooks and error pages included) on a pool
+            of `workers` threads. Sub-requests inherit the headers of 
+            the batch request, except the content, encoding negotiation
+            and conditional ones.
+
+            The response is streamed as `application/x-ndjson`, one line
+            per finished sub-request: `index`, `status`, `headers` and
+            `body`, a body which isn't valid utf8 text is base64 encoded 
+            and flagged with `"encoding": "base64"`. Batches larger than `max_size` are rejected with 
+            `413`, sub-requests not finished within `timeout` seconds 
+            are reported with status `504`.
+
+            Note that `timeout` only bounds the response, a sub-request
+            which is already running can't be cancelled and keeps its 
+            worker until it returns. While every worker is held by such
+            stuck sub-requests, new batches are rejected with `503`. """
+
+        if ThreadPoolExecutor is None:
+            raise EngineError("batch route requires `concurrent.futures`, "
+                                "install the `futures` backport on Py2.")
+
+        pool = _BatchPool(workers)
+        self.batch_pools[regex] = pool
+
+        def _batch():
+            request = self.content.request
+            # Nested batch request is not allowed.
+            if request.environ.get("vanilla.batch", False):
+                raise HttpError(400)
+
+            # Every worker is stuck, don't queue behind them.
+            if pool.saturated():
+                error = HttpError(503)
+                error.set_header("Retry-After", 1)
+                raise error
+
+            try:
+                subs = json.loads(request.data)
+            except (AttributeError, ValueError):
+                raise HttpError(400)
+            if not isinstance(subs, list) or \
+                    not all(isinstance(sub, dict) for sub in subs):
+                raise HttpError(400)
+            if len(subs) > max_size:
+                raise HttpError(413)
+
+            self.content.response.set_header("Content-Type", 
+                                                "application/x-ndjson")
+            return self._batch_stream(pool, request.environ, subs, timeout)
+
+        return self.route(regex, methods, _batch, **rule_options)
+
+    def _sub_request(self, environ, sub):
+        """ Dispatch one sub-request of batch, run on the batch pool. """
+
+        body  = sub.get("body", None) or ""
+        query = sub.get("query", None) or ""
+        content_type = "text/plain; charset=UTF-8"
+        if not isinstance(body, (bytes, unicode)):
+            body = json.dumps(body)
+            content_type = "application/json"
+        if isinstance(query, dict):
+            query = urlencode(query, doseq=True)
+        body = u2b(body)
+
+        environ = dict(environ)
+        for key in _BATCH_STRIP_ENVIRON:
+            environ.pop(key, None)
+        environ.update({"REQUEST_METHOD": str(sub.get("method", "GET")),
+                        "PATH_INFO": str(sub.get("path", "/")),
+                        "QUERY_STRING": str(query),
+                        "CONTENT_TYPE": str(sub.get("content_type", 
+                                                        content_type)),
+                        "CONTENT_LENGTH": str(len(body)),
+                        "wsgi.input": BytesIO(body),
+                        "vanilla.batch": True})
+
+        try:
+            buf      = self._request_handler(environ)
+            response = self._make_output(buf)
+        finally:
+            self._memtrace_end()
+
+        if hasattr(response.body, 'read'):
+            try:
+                data = response.body.read()
+            finally:
+                response.body.close()
+        else:
+            data = b"".join(response.body)
+
+        result = {"status": response.status_code, 
+                    "headers": response.header_fields}
+        try:
+            result["body"] = b2u(data)
+        except UnicodeDecodeError:
+            result["body"] = b2u(base64.b64encode(data))
+            result["encoding"] = "base64"
+        return result
+
+    def _batch_stream(self, pool, environ, subs, timeout):
+        """ Dispatch sub-requests, yield the result of them as soon as 
+                they finish. 
+                
+            Nothing is dispatched until the server starts iterating, so 
+            a batch closed before that never runs. """
+
+        futures  = dict()
+        deadline = time.time() + timeout
+        for index, sub in enumerate(subs):
+            futures[pool.submit(self._sub_request, environ, sub)] = index
+
+        pending = set(futures.keys())
+        try:
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                done, pending = wait(pending, timeout=remaining, 
+                                        return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except:
+                        result = {"status": 500, "headers": [], 
+                                    "body": _HTTP_ERROR_PAGE_CONTENT}
+                    result["index"] = futures[future]
+                    yield json.dumps(result) + "\n"
+        finally:
+            # Timeout or client gone, give up everything not finished yet.
+            pool.abandon(pending)
+
+        for future in pending:
+            yield json.dumps({"index": futures[future], "status": 504, 
+                                "headers": [], "body": ""}) + "\n"
+
     def abort(self, buf):
         """ Abort the current http request process.
 
@@ -265,8 +626,17 @@ class Engine(object):
     def wsgi(self, environ, start_response):
         """ WSGI Handler. """
 
-        buf      = self._request_handler(environ)
-        response = self._make_output(buf)
+        started  = time.time()
+        try:
+            buf      = self._request_handler(environ)
+            response = self._make_output(buf)
+        finally:
+            # Close the memory sample on every exit path.
+            self._memtrace_end()
+
+        if self.access_log is not None:
+            self.access_log.log(self.content.request, response, 
+                                    time.time() - started)
         
         start_response(response.status_line, response.header_fields)
         return response.body
@@ -275,21 +645,226 @@ class Engine(object):
         """ Handle request, init request/response instance and return 
                 response buffer. """
 
+        started = time.time()
         self.content.request = HttpRequest(environ)
         self.content.response = HttpResponse()
+        self.content.memtrace = None
+        self.content.deadline = None
 
         try:
-
             rule = self.router.match(self.content.request.method, 
                                             self.content.request.path)
+        except:
+            return self._error_handler()
+
+        timeout = rule.deadline if rule.deadline is not None \
+                                    else self.deadline
+        if timeout:
+            self.content.deadline = started + timeout
+
+        limiter = self.limiters.get(rule.limit or "default", None)
+        if limiter is None:
+            return self._run(rule, None)
+
+        # Admission control, reject before any hook or template runs.
+        if not limiter.acquire(self.content.remaining()):
+            if self.content.remaining() == 0:
+                self._deadline_missed(rule)
+                return self._timeout()
+            return self._overloaded(limiter.retry_after)
+
+        acquired = time.time()
+
+        def _release():
+            limiter.release(time.time() - acquired)
+
+        return self._run(rule, _release)
+
+    def _run(self, rule, release):
+        """ Execute the rule, bounded by the request deadline if any,
+                `release` (if not None) is called once the execution 
+                is really finished.
+
+            With a deadline the rule is executed on the deadline worker
+            pool with the same http context, the request thread waits 
+            until the deadline and answers a fast `504` if the work isn't
+            finished. The stuck work is abandoned, it keeps running in 
+            background (holding its worker and limiter slot) but its 
+            result is discarded. When every worker is busy the rule is 
+            executed on the request thread, only post-processors and 
+            error pages respect the deadline then. """
+
+        # Budget already spent (e.g.: waiting in the limiter queue).
+        if self.content.deadline is not None and \
+                self.content.remaining() == 0:
+            if release is not None:
+                release()
+            self._deadline_missed(rule)
+            return self._timeout()
+
+        parent = self.content.export()
+        result = dict()
+        state  = {"abandoned": False, "thread": None}
+        done   = Event()
+
+        def _worker():
+            state["thread"] = current_thread()
+            self.content.bind(parent)
+            try:
+                result["buf"] = self._execute(rule)
+            except:
+                result["error"] = _errno()
+            finally:
+                if release is not None:
+                    release()
+            with self.deadline_lock:
+                result["ctx"] = self.content.export()
+                done.set()
+                abandoned = state["abandoned"]
+                if abandoned:
+                    self.deadline_abandoned -= 1
+            # Nobody will make output for the abandoned work.
+            if abandoned and self.memprof is not None:
+                self.memprof.discard(state["thread"])
+
+        if self.content.deadline is None or \
+                not self.deadline_pool.submit(_worker):
+            try:
+                _buf = self._execute(rule)
+            finally:
+                if release is not None:
+                    release()
+            if self.content.response.status_code == 504 and \
+                    self.content.remaining() == 0:
+                self._deadline_missed(rule)
+            return _buf
+
+        done.wait(self.content.remaining())
+        with self.deadline_lock:
+            if not done.is_set():
+                state["abandoned"] = True
+                self.deadline_abandoned += 1
+
+        if state["abandoned"]:
+            # Drop the memory sample of abandoned work now, or it would
+            #   count every other thread's allocations until it returns.
+            if self.memprof is not None and state["thread"] is not None:
+                self.memprof.discard(state["thread"])
+            self._deadline_missed(rule)
+            return self._timeout()
+
+        self.content.bind(result["ctx"])
+        if self.content.response.status_code == 504 and \
+                self.content.remaining() == 0:
+            self._deadline_missed(rule)
+        if "error" in result:
+            raise result["error"]
+        return result["buf"]
+
+    def _execute(self, rule):
+        """ Dispatch the rule, identical concurrent `GET`/`HEAD` requests 
+                of a coalesced rule share one execution (single-flight).
+            
+            Every request runs the pre-processors by itself, then the
+            first one (leader) runs the callback and post-processors, 
+            others wait for its status, the headers set after its 
+            pre-processors and body, or its exception if the engine 
+            doesn't catch exceptions. Followers fall back to their own
+            execution if the leader doesn't finish within the 
+            `coalesce_timeout`, returns a file-like/iterable body or a
+            response with `Set-Cookie` header, which can't be shared. """
+
+        request = self.content.request
+        if not rule.coalesce or request.method not in ("GET", "HEAD"):
+            return self._dispatch(rule)
+
+        try:
+            self._preprocess(rule)
+        except HttpAbort:
+            context = _errno()
+            return context.buf
+        except:
+            return self._error_handler()
+
+        key = rule.coalesce_key(request)
+        with self.flight_lock:
+            flight = self.flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+
+        if leader:
+            before = dict((name, list(values)) for name, values
+                                in self.content.response.headers.items())
+            try:
+                # Publish the real result even if the leader itself is
+                #   out of time, followers may still have budget left.
+                _buf = self._dispatch(rule, preprocess=False, 
+                                        deadline=False)
+                flight.finish(_buf, self.content.response, before)
+                if self.content.remaining() == 0:
+                    return self._timeout()
+                return _buf
+            except:
+                flight.fail(_errno())
+                raise
+            finally:
+                with self.flight_lock:
+                    del self.flights[key]
+
+        # Don't wait longer than our own deadline.
+        timeout = rule.coalesce_timeout
+        if self.content.remaining() is not None:
+            timeout = min(timeout, self.content.remaining())
+
+        if not flight.wait(timeout) or not flight.shareable:
+            with self.flight_lock:
+                self.flight_stat["fallback"] += 1
+            return self._dispatch(rule, preprocess=False)
+
+        with self.flight_lock:
+            self.flight_stat["shared"] += 1
+
+        if flight.error is not None:
+            raise flight.error
+
+        response = self.content.response
+        response.status = flight.status
+        for name, values in flight.headers.items():
+            response.headers[name] = list(values)
+        return flight.buf
+
+    def _preprocess(self, rule):
+        """ Invoke the pre-processors for rule. """
+
+        self.content.rule = rule
+        if self.request_preprocessor:
+            for processor in self.request_preprocessor:
+                processor()
+
+    def _dispatch(self, rule, preprocess=True, deadline=True):
+        """ Invoke hooks and the request rule, return response buffer. 
+        
+            If `deadline` is False, post-processors run even if the 
+            request is out of time. """
+
+        try:
+
             # Pre-processor.
-            self.content.rule = rule
-            if self.request_preprocessor:
-                for processor in self.request_preprocessor:
-                    processor()
+            if preprocess:
+                self._preprocess(rule)
+
+            # Don't sample work which is out of time (maybe abandoned).
+            if self.memprof is not None and self.content.remaining() != 0:
+                self.content.memtrace = self.memprof.begin()
 
             _buf = self.content.rule.make_call(self.content.request.path)
 
+            # Out of time, skip post-processor.
+            if deadline and self.content.remaining() == 0:
+                raise HttpError(504)
+
             # Post-processor.
             self.content.response.body = _buf
             if self.request_postprocessor:
@@ -301,12 +876,22 @@ class Engine(object):
         except HttpAbort:
             context = _errno()
             return context.buf
+        except:
+            return self._error_handler()
+
+    def _error_handler(self):
+        """ Turn the exception currently being handled into http error 
+                response, must be called inside an `except` block. """
+
+        error = _errno()
+
         # Not Found or Forbidden or http error which raised by ourself.
-        except HttpError:
-            self.content.response = _errno()
+        if isinstance(error, HttpError):
+            self.content.response = error
         # Other unexpected error, treat as http error 500.
-        except:
+        else:
             if not self.catch:
+                self._memtrace_end()
                 raise
             self.content.response = HttpError(500)
             # when debug is enabled, unexcept error traceback
@@ -318,6 +903,10 @@ class Engine(object):
         status_code = self.content.response.status_code
         err_handler = self.err_handler.get(int(status_code), None)
 
+        # Out of time, don't render error page.
+        if self.content.remaining() == 0:
+            err_handler = None
+
         if err_handler:
             try:        
                 # We have error handler for this error.
@@ -335,9 +924,47 @@ class Engine(object):
 
         return _buf
 
+    def _memtrace_end(self):
+        """ Finish the memory sample of current request, if any. """
+
+        token = self.content.memtrace
+        if token is not None:
+            self.content.memtrace = None
+            self.memprof.end(self.content.rule.regex.pattern, token)
+
+    def _deadline_missed(self, rule):
+        """ Count deadline miss of rule. """
+        with self.deadline_lock:
+            route = rule.regex.pattern
+            self.deadline_miss[route] = self.deadline_miss.get(route, 0) + 1
+
+    def _timeout(self):
+        """ Fast `504` response for request out of time, no hooks, no 
+                error handler and no template involved. """
+
+        self.content.response = HttpError(504)
+        return _HTTP_ERROR_PAGE_CONTENT
+
+    def _overloaded(self, retry_after):
+        """ Fast `503` response for rejected request, no hooks, no error 
+                handler and no template involved. """
+
+        response = HttpError(503)
+        response.set_header("Retry-After", retry_after)
+        self.content.response = response
+        return _HTTP_ERROR_PAGE_CONTENT
+
     def _make_output(self, buf):
         """ Parse response buf, 
                 make sure response instance WSGI compatible. """
+
+        try:
+            return self._make_body(buf)
+        finally:
+            self._memtrace_end()
+
+    def _make_body(self, buf):
+        """ Turn response buf into WSGI compatible response body. """
         
         request  = self.content.request
         response = self.content.response
@@ -359,6 +986,17 @@ class Engine(object):
                 response.body = buf
             return response
 
+        # Static bundle content, WSGI requires bytes so this is the only
+        #   copy made of it.
+        if isinstance(buf, _BUFFER_TYPES):
+            response.body = [bytes(buf)]
+            return response
+
+        # Streaming content.
+        if isinstance(buf, types.GeneratorType):
+            response.body = _encode_stream(buf)
+            return response
+
         # Normal content.
         response.body = [u2b(buf)]
 
@@ -375,7 +1013,7 @@ class RequestRouter(object):
         for method in _HTTP_METHOD:
             self.method_table[method] = list()
 
-    def insert(self, methods, regex, callback):
+    def insert(self, methods, regex, callback, **rule_options):
         """ Insert rule into corresponding method table. """
 
         if not isinstance(methods, list):
@@ -386,7 +1024,7 @@ class RequestRouter(object):
             if method not in _HTTP_METHOD:
                 raise RouterError("Request method {0} for callback "
                     "{1} not supported.".format(method, callback.__name__))
-            rule = RequestRule(regex, callback)
+            rule = RequestRule(regex, callback, **rule_options)
             self.method_table[method].append(rule)
 
     def match(self, method, url):
@@ -413,12 +1051,36 @@ class RequestRouter(object):
 class RequestRule(object):
     """ Rule object for warp callback function with regex and some metadata. """
 
-    def __init__(self, regex, callback):
-        """ Compile regex and prepare callback. """
+    def __init__(self, regex, callback, limit=None, 
+                        coalesce=False, coalesce_timeout=5.0, deadline=None):
+        """ Compile regex and prepare callback. 
+        
+            Options:
+                `limit`, name of the admission control class (see 
+                    `Engine.limit`) this rule belongs to.
+                `coalesce`, share one execution between identical 
+                    concurrent `GET`/`HEAD` requests, requests are
+                    identical if method, path, query string, `Cookie`
+                    and `Authorization` headers are the same, pass a 
+                    list of request header names instead of True to 
+                    also vary on these headers.
+                `coalesce_timeout`, seconds to wait for the shared
+                    execution before run independently.
+                `deadline`, seconds a request of this rule may take,
+                    override the engine wide `appDeadline`, 0 means 
+                    no deadline for this rule. """
 
         self.regex         = re.compile(regex)
         self.handler       = callback
         self.handler_args  = None
+        self.limit         = limit
+        self.deadline      = deadline
+
+        self.coalesce         = coalesce
+        self.coalesce_timeout = coalesce_timeout
+        self.coalesce_vary    = list()
+        if isinstance(coalesce, (list, tuple)):
+            self.coalesce_vary = list(coalesce)
 
         # Gather info about our callback
         spec = getfullargspec(callback)
@@ -440,6 +1102,56 @@ class RequestRule(object):
         """ Invoke callback with args. """
         return self.handler(**self.update_args(url))
 
+    def coalesce_key(self, request):
+        """ Return the single-flight key of request. """
+
+        key = [request.method, request.path, request.query_string]
+        for header in ["Cookie", "Authorization"] + self.coalesce_vary:
+            key.append(request.environ.get(
+                            request._environ_header_key(header), None))
+        return tuple(key)
+
+
+class _Flight(object):
+    """ One in-flight execution of a coalesced rule. """
+
+    def __init__(self):
+        """ Init empty result. """
+        self.buf       = None
+        self.error     = None
+        self.status    = None
+        self.headers   = None
+        self.shareable = False
+        self._done     = Event()
+
+    def finish(self, buf, response, before):
+        """ Publish the result of leader, `before` is the response 
+                headers right after the leader's pre-processors. """
+
+        self.buf     = buf
+        self.status  = response.status
+        self.headers = dict((name, list(values)) 
+                                for name, values in response.headers.items()
+                                if before.get(name, None) != values)
+        # A `504` is most likely the leader running out of its own time,
+        #   followers may still have budget left.
+        self.shareable = isinstance(buf, (bytes, unicode)) and \
+                            response.status != 504 and \
+                            not any(name.lower() == "set-cookie" 
+                                        for name in response.headers.keys())
+        self._done.set()
+
+    def fail(self, error):
+        """ Publish the exception raised by leader. """
+        self.error     = error
+        self.shareable = True
+        self._done.set()
+
+    def wait(self, timeout):
+        """ Wait for the leader, return False on timeout. """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
 
 ## Http Context ##
 class HttpContext(object):
@@ -460,6 +1172,23 @@ class HttpContext(object):
         """ Associate http context. """
         self.thread_ctx.__dict__[name] = value
 
+    def remaining(self):
+        """ Return seconds left before the deadline of current request, 
+                or None if the request doesn't have one. """
+        deadline = self.thread_ctx.__dict__.get("deadline", None)
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0)
+
+    def export(self):
+        """ Return a copy of the http context of current thread. """
+        return dict(self.thread_ctx.__dict__)
+
+    def bind(self, ctx):
+        """ Replace the http context of current thread with `ctx`. """
+        self.thread_ctx.__dict__.clear()
+        self.thread_ctx.__dict__.update(ctx)
+
 
 ## Http Request ##
 class HttpRequest(object):
@@ -492,6 +1221,11 @@ class HttpRequest(object):
         """ environ['SERVER_PORT'] """
         return self.environ.get('SERVER_PORT', _HTTP_PORT)
 
+    @property
+    def remote_addr(self):
+        """ environ['REMOTE_ADDR'] """
+        return self.environ.get('REMOTE_ADDR', "-")
+
     @property
     def method(self):
         """ environ['REQUEST_METHOD'] """
@@ -670,6 +1404,700 @@ class HttpResponse(object):
         self.headers[name] = [value]
 
 
+class _WorkerPool(object):
+    """ Bounded pool of reused daemon threads, started on demand. """
+
+    def __init__(self, size, name):
+        """ Init empty pool. """
+        self.size    = int(size)
+        self.name    = name
+        self.busy    = 0
+        self.threads = 0
+
+        self._tasks = deque()
+        self._cond  = Condition()
+
+    def submit(self, func):
+        """ Run `func` on an idle worker, return False if every worker 
+                is busy. """
+
+        with self._cond:
+            if self.busy >= self.size:
+                return False
+            self.busy += 1
+            self._tasks.append(func)
+
+            # No idle worker, start a new one.
+            if self.threads < self.busy:
+                self.threads += 1
+                thread = Thread(target=self._loop, name=self.name)
+                thread.daemon = True
+                thread.start()
+            else:
+                self._cond.notify()
+            return True
+
+    def _loop(self):
+        """ Worker thread main loop. """
+
+        while True:
+            with self._cond:
+                while not self._tasks:
+                    self._cond.wait()
+                func = self._tasks.popleft()
+            try:
+                func()
+            finally:
+                with self._cond:
+                    self.busy -= 1
+
+
+class _BatchPool(object):
+    """ Worker pool of a batch route, keep track of stuck workers. """
+
+    def __init__(self, workers):
+        """ Create the thread pool. """
+        self.workers   = int(workers)
+        self.abandoned = 0
+        self.executor  = ThreadPoolExecutor(max_workers=self.workers)
+        self._lock     = Lock()
+
+    def submit(self, func, *args):
+        """ Schedule one sub-request. """
+        return self.executor.submit(func, *args)
+
+    def saturated(self):
+        """ Return True if every worker is held by abandoned work. """
+        return self.abandoned >= self.workers
+
+    def abandon(self, futures):
+        """ Cancel futures not started yet, running ones are counted as
+                abandoned until they finish. """
+        for future in futures:
+            if future.cancel():
+                continue
+            with self._lock:
+                self.abandoned += 1
+            future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        """ An abandoned sub-request finally returned. """
+        with self._lock:
+            self.abandoned -= 1
+
+    def stats(self):
+        """ Return current state of this pool. """
+        return {"workers": self.workers, "abandoned": self.abandoned}
+
+
+## Admission Control ##
+class ConcurrencyLimiter(object):
+    """ Limit the number of in-flight requests of one route class.
+
+        Requests over `limit` wait in a bounded queue until a slot is
+        released or the `queue_timeout` expired, requests which can't
+        enter the queue are rejected at once.
+
+        With `adaptive` enabled the limit is tuned by AIMD between 
+        `min_inflight` and `max_inflight`: every request slower than
+        `target_latency` seconds cut the limit by `backoff`, every 
+        faster one (while the limit is actually used) raise it by 
+        `1/limit`, which means about one slot per full window. """
+
+    def __init__(self, max_inflight, queue_size=0, queue_timeout=1.0, 
+                        retry_after=1, adaptive=False, min_inflight=1,
+                        target_latency=1.0, backoff=0.9):
+        """ Init limiter state. """
+
+        self.max_inflight   = int(max_inflight)
+        self.min_inflight   = max(1, min(int(min_inflight), 
+                                                self.max_inflight))
+        self.queue_size     = int(queue_size)
+        self.queue_timeout  = float(queue_timeout)
+        self.retry_after    = retry_after
+        self.adaptive       = adaptive
+        self.target_latency = float(target_latency)
+        self.backoff        = float(backoff)
+
+        self.limit    = float(self.max_inflight)
+        self.inflight = 0
+        self.waiting  = 0
+        self.accepted = 0
+        self.rejected = 0
+
+        self._cond = Condition()
+
+    def acquire(self, timeout=None):
+        """ Take one slot, return False if over capacity. 
+        
+            `timeout` (if not None) cap the time waiting in queue, 
+            e.g.: the time left before the request deadline. """
+
+        with self._cond:
+            # Don't jump ahead of requests already waiting in queue.
+            if self.waiting == 0 and self.inflight < int(self.limit):
+                self.inflight += 1
+                self.accepted += 1
+                return True
+
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+
+            wait_time = self.queue_timeout
+            if timeout is not None:
+                wait_time = min(wait_time, timeout)
+
+            self.waiting += 1
+            deadline = time.time() + wait_time
+            try:
+                while self.inflight >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.inflight += 1
+            self.accepted += 1
+            return True
+
+    def release(self, latency):
+        """ Give back the slot, `latency` is the request process time. """
+
+        with self._cond:
+            if self.adaptive:
+                if latency > self.target_latency:
+                    self.limit = max(self.min_inflight, 
+                                        self.limit * self.backoff)
+                elif self.inflight >= int(self.limit):
+                    self.limit = min(self.max_inflight, 
+                                        self.limit + 1.0 / self.limit)
+            self.inflight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        """ Return current state of this limiter. """
+        return {"limit": int(self.limit),
+                "max_inflight": self.max_inflight,
+                "inflight": self.inflight,
+                "waiting": self.waiting,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "adaptive": self.adaptive}
+
+
+## Memory Profiler ##
+class MemoryProfiler(object):
+    """ Sampled per route memory allocation tracking.
+
+        Only one request is traced at a time, a request is skipped if
+        another sample is still in progress. If `tracemalloc` is not
+        already tracing, tracing is started for the sampled request only
+        so non-sampled requests don't pay for it, otherwise a snapshot
+        taken before the request is used as diff base.
+
+        Note that `tracemalloc` is process wide, allocations made by 
+        other threads during a sample are counted as well. """
+
+    def __init__(self, sample_rate=0.01, frames=1, sites=5):
+        """ Init profiler state. """
+
+        if tracemalloc is None:
+            raise EngineError("memory profile requires `tracemalloc`.")
+
+        self.sample_rate = float(sample_rate)
+        self.frames      = int(frames)
+        self.sites       = int(sites)
+        self.routes      = dict()
+
+        self._lock    = Lock()
+        self._busy    = Lock()
+        self._sample  = None
+        self._filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+    def begin(self):
+        """ Start a sample, return token or None if not sampled. """
+
+        if random.random() >= self.sample_rate:
+            return None
+        if not self._busy.acquire(False):
+            return None
+
+        if tracemalloc.is_tracing():
+            before = tracemalloc.take_snapshot().filter_traces(self._filters)
+        else:
+            before = None
+            tracemalloc.start(self.frames)
+
+        if hasattr(tracemalloc, "reset_peak"):  # Py3.9+
+            tracemalloc.reset_peak()
+        current, peak = tracemalloc.get_traced_memory()
+
+        token = (current_thread(), before, current)
+        with self._lock:
+            self._sample = token
+        return token
+
+    def discard(self, thread):
+        """ Drop the sample in progress if it was started by `thread`. """
+
+        with self._lock:
+            token = self._sample
+            if token is None or token[0] is not thread:
+                return
+            self._sample = None
+
+        if token[1] is None:
+            tracemalloc.stop()
+        self._busy.release()
+
+    def end(self, route, token):
+        """ Finish a sample, account the result to `route`, do nothing
+                if the sample was discarded. """
+
+        with self._lock:
+            if self._sample is not token:
+                return
+            self._sample = None
+
+        thread, before, base = token
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(self._filters)
+            if before is None:
+                tracemalloc.stop()
+                stats = after.statistics("lineno")
+                sizes = [stat.size for stat in stats]
+            else:
+                stats = after.compare_to(before, "lineno")
+                sizes = [stat.size_diff for stat in stats]
+        finally:
+            self._busy.release()
+
+        retained = sum(sizes)
+        peak     = max(peak - base, 0)
+        sites    = [(str(stat.traceback), size) 
+                        for stat, size in list(zip(stats, sizes))[:self.sites]]
+
+        with self._lock:
+            stat = self.routes.get(route, None)
+            if stat is None:
+                stat = {"route": route, "samples": 0, "peak": 0, 
+                        "retained": 0, "retained_max": 0, "sites": []}
+                self.routes[route] = stat
+            stat["samples"]  += 1
+            stat["retained"] += retained
+            stat["peak"]      = max(stat["peak"], peak)
+            if retained >= stat["retained_max"]:
+                stat["retained_max"] = retained
+                stat["sites"] = sites
+
+    def report(self, top=10):
+        """ Return the `top` routes ordered by total retained bytes,
+                each one with sample count, max peak bytes, total and 
+                max retained bytes and the top allocation sites of the
+                worst sample. """
+
+        with self._lock:
+            stats = [dict(stat) for stat in self.routes.values()]
+        stats.sort(key=lambda stat: stat["retained"], reverse=True)
+        return stats[:top]
+
+    def reset(self):
+        """ Drop all collected samples. """
+        with self._lock:
+            self.routes = dict()
+
+
+## Static Bundle ##
+_BUNDLE_MAGIC  = b"VSB1"
+_BUNDLE_HEADER = struct.Struct("<4sQQ")
+
+
+def _accept_gzip(accept_encoding):
+    """ Return True if `Accept-Encoding` header allow gzip, honor the
+            q-values and the `*` wildcard. """
+
+    qvalues = dict()
+    for coding in accept_encoding.split(","):
+        params = coding.strip().split(";")
+        name   = params[0].strip().lower()
+        if not name:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name] = qvalue
+
+    if "gzip" in qvalues:
+        return qvalues["gzip"] > 0
+    return qvalues.get("*", 0) > 0
+
+
+def _etag_match(etag, if_none_match):
+    """ Return True if `etag` match `If-None-Match` header, which is a
+            comma separated list of (weak) ETags or `*`. """
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def pack_static(source, archive, compress=True, min_size=256):
+    """ Pack every file under `source` directory into one static bundle.
+
+        The archive is a fixed header (magic, index offset and length) 
+        followed by file contents and a json index, which map the path
+        relative to `source` to its mime type, encoding, ETag, mtime and
+        the (offset, length) of the content, plus the precompressed gzip
+        variant when `compress` is enabled and the file is larger than 
+        `min_size` and actually shrinks.
+
+        The archive is written to a temp file and renamed into place, so
+        a running `StaticBundle` can be swapped to it safely. """
+
+    index  = dict()
+    tmp    = "{0}.{1}.tmp".format(archive, os.getpid())
+    offset = _BUNDLE_HEADER.size
+
+    # The archive may live inside `source`, never pack it (or its temp
+    #   files) into itself.
+    skip = os.path.abspath(archive)
+
+    try:
+        with open(tmp, "wb") as fp:
+            fp.write(b"\0" * offset)
+
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    abspath  = os.path.abspath(filepath)
+                    if abspath == skip or (abspath.startswith(skip + ".") 
+                                            and abspath.endswith(".tmp")):
+                        continue
+
+                    relpath  = os.path.relpath(filepath, source)
+                    relpath  = relpath.replace(os.sep, "/")
+
+                    with open(filepath, "rb") as src:
+                        data = src.read()
+
+                    mime_type, encoding = mimetypes.guess_type(filepath)
+                    meta = {"mime": mime_type or "application/octet-stream",
+                            "encoding": encoding,
+                            "etag": '"{0}"'.format(
+                                        hashlib.sha1(data).hexdigest()[:20]),
+                            "mtime": os.stat(filepath).st_mtime,
+                            "data": [offset, len(data)],
+                            "gzip": None}
+                    fp.write(data)
+                    offset += len(data)
+
+                    if compress and not encoding and len(data) >= min_size:
+                        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+                        packed = compressor.compress(data) + \
+                                    compressor.flush()
+                        if len(packed) < len(data) * 0.9:
+                            meta["gzip"] = [offset, len(packed)]
+                            fp.write(packed)
+                            offset += len(packed)
+
+                    index[relpath] = meta
+
+            raw_index = u2b(json.dumps(index))
+            fp.write(raw_index)
+            fp.seek(0)
+            fp.write(_BUNDLE_HEADER.pack(_BUNDLE_MAGIC, offset, 
+                                            len(raw_index)))
+
+        # `os.rename` can't overwrite an existing archive on Windows.
+        getattr(os, "replace", os.rename)(tmp, archive)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return len(index)
+
+
+class StaticBundle(object):
+    """ Read only, memory-mapped static bundle built by `pack_static`. """
+
+    def __init__(self, filepath):
+        """ Map the archive. """
+        self.filepath = None
+        self._archive = None
+        self.load(filepath)
+
+    def load(self, filepath):
+        """ Map a new archive and swap it in.
+
+            The old archive is never closed explicitly, the memoryview
+            (`buffer` on Py2) slices still being sent keep it alive and
+            it is unmapped once the last of them is gone. """
+
+        try:
+            with open(filepath, "rb") as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            raise EngineError("can't map static bundle {0}: {1}".format(
+                                                        filepath, _errno()))
+
+        try:
+            magic, offset, length = _BUNDLE_HEADER.unpack_from(mapped, 0)
+            if magic != _BUNDLE_MAGIC or offset + length > len(mapped):
+                raise ValueError("bad header")
+            index = json.loads(b2u(mapped[offset:offset + length]))
+        except (struct.error, ValueError):
+            mapped.close()
+            raise EngineError("{0} is not a static bundle.".format(filepath))
+
+        try:
+            view = memoryview(mapped)
+        except TypeError:   # Py2
+            view = None
+
+        # Single reference assignment, readers always see a consistent
+        #   (mapped, view, index) tuple.
+        self._archive = (mapped, view, index)
+        self.filepath = filepath
+
+    def _slice(self, mapped, view, offset, length):
+        """ Zero-copy slice of the archive. """
+        if view is None:
+            return buffer(mapped, offset, length)
+        return view[offset:offset + length]
+
+    def lookup(self, filepath, gzip=False):
+        """ Return (meta, encoding, etag, memoryview) of `filepath` or
+                None if not found in bundle, prefer the gzip variant if 
+                `gzip` is True and it exists. """
+
+        mapped, view, index = self._archive
+        meta = index.get(filepath.lstrip("/"), None)
+        if meta is None:
+            return None
+
+        if gzip and meta["gzip"] is not None:
+            offset, length = meta["gzip"]
+            return (meta, "gzip", meta["etag"][:-1] + '-gz"', 
+                        self._slice(mapped, view, offset, length))
+
+        offset, length = meta["data"]
+        return (meta, meta["encoding"], meta["etag"], 
+                    self._slice(mapped, view, offset, length))
+
+
+## Access Log ##
+class AccessLogger(object):
+    """ Asynchronous, batched access log writer.
+
+        Request threads only capture the raw fields of each request and
+        append them to a bounded queue (`deque.append` is atomic, no lock
+        is taken on the hot path). A dedicated writer thread formats the
+        records in batches, writes them with one large `write` call,
+        flushes every `flush_interval` seconds and rotates the file once
+        it grows beyond `max_bytes` (0 disable rotation).
+
+        When the queue is full the record is dropped and counted in
+        `dropped` instead of blocking the request.
+
+        The writer thread is started by the first record logged in each
+        process, so preload-then-fork servers get one writer per worker
+        process. """
+
+    log_format = u'{0} - - [{1}] "{2} {3}{4} {5}" {6} {7} "{8}" "{9}" {10:.6f}\n'
+
+    def __init__(self, filepath, queue_size=8192, batch_size=512,
+                        flush_interval=1.0, max_bytes=0, backup_count=5):
+        """ Open the log file, the writer thread is started lazily. """
+
+        self.filepath       = filepath
+        self.queue_size     = int(queue_size)
+        self.batch_size     = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.max_bytes      = int(max_bytes)
+        self.backup_count   = int(backup_count)
+
+        self.written = 0
+        self.dropped = 0
+
+        self._queue   = deque()
+        self._wakeup  = Event()
+        self._closed  = False
+        self._lock    = Lock()
+        self._fp      = open(self.filepath, "ab")
+        self._fp_pid  = os.getpid()
+        self._pid     = None
+        self._thread  = None
+        atexit.register(self.close)
+
+    def _start(self):
+        """ Start the writer thread of current process. """
+
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+
+            # Forked child, records still queued belong to the parent.
+            if self._fp_pid != pid:
+                self._queue.clear()
+                self._wakeup = Event()
+                self._fp     = open(self.filepath, "ab")
+                self._fp_pid = pid
+
+            self._thread = Thread(target=self._writer, 
+                                    name="vanilla-access-log")
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def log(self, request, response, duration):
+        """ Queue one access record, never block the caller. """
+
+        if self._pid != os.getpid():
+            self._start()
+
+        if self._closed or len(self._queue) >= self.queue_size:
+            with self._lock:
+                self.dropped += 1
+            return
+
+        environ = request.environ
+        length  = response.get_header("Content-Length")
+        if length:
+            length = length[0]
+        elif isinstance(response.body, list):
+            length = sum(len(chunk) for chunk in response.body)
+        else:
+            length = "-"
+
+        self._queue.append((time.time(), 
+                            request.remote_addr, 
+                            request.method, 
+                            request.path, 
+                            request.query_string,
+                            request.protocol_version, 
+                            response.status_code, 
+                            length,
+                            environ.get("HTTP_REFERER", "-"), 
+                            environ.get("HTTP_USER_AGENT", "-"),
+                            duration))
+
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def stats(self):
+        """ Return counters of this access log. """
+        return {"queued": len(self._queue), 
+                "written": self.written, 
+                "dropped": self.dropped}
+
+    def close(self):
+        """ Stop the writer thread after draining the queue. """
+
+        if self._closed:
+            return
+        self._closed = True
+        if self._pid == os.getpid():
+            self._wakeup.set()
+            self._thread.join()
+        self._fp.close()
+
+    def _format(self, record):
+        """ Format one queued record into a log line. """
+
+        (stamp, addr, method, path, qs, proto, 
+                status, length, referer, agent, duration) = record
+        stamp = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(stamp))
+        qs    = "?" + qs if qs else ""
+
+        return self.log_format.format(addr, stamp, method, path, qs, proto,
+                                        status, length, referer, agent, 
+                                        duration)
+
+    def _writer(self):
+        """ Writer thread main loop. """
+
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            while self._queue:
+                batch = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append(self._format(self._queue.popleft()))
+                try:
+                    self._fp.write(u2b(u"".join(batch), errors="replace"))
+                    self.written += len(batch)
+                    if self.max_bytes and self._fp.tell() >= self.max_bytes:
+                        self._rotate()
+                except (IOError, OSError, ValueError):
+                    with self._lock:
+                        self.dropped += len(batch)
+                    self._reopen()
+
+            try:
+                self._fp.flush()
+            except (IOError, OSError, ValueError):
+                self._reopen()
+
+            if self._closed and not self._queue:
+                break
+
+    def _reopen(self):
+        """ Reopen the log file after a write error, keep the old handle 
+                if the file can't be opened. """
+
+        try:
+            fp = open(self.filepath, "ab")
+        except (IOError, OSError):
+            return
+
+        old, self._fp = self._fp, fp
+        try:
+            old.close()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _rotate(self):
+        """ Rotate log file, keep at most `backup_count` old files.
+
+            Files are renamed while the current handle is still open, the
+            log file is reopened even if renaming failed (e.g. the log
+            directory was removed and recreated), and the old handle is 
+            kept for writing if it can't be. """
+
+        try:
+            for index in range(self.backup_count - 1, 0, -1):
+                src = "{0}.{1}".format(self.filepath, index)
+                if os.path.exists(src):
+                    os.rename(src, "{0}.{1}".format(self.filepath, index + 1))
+            if self.backup_count > 0:
+                os.rename(self.filepath, self.filepath + ".1")
+            else:
+                os.remove(self.filepath)
+        except (IOError, OSError):
+            pass
+        self._reopen()
+
+
 ## Http Error Rsponse ##
 class HttpError(HttpResponse, VanillaError):
     """ Http error response. """
@@ -677,3 +2105,14 @@ class HttpError(HttpResponse, VanillaError):
     def __init__(self, status=500, body=""):
         super(HttpError, self).__init__(status, body)
 
+
+## Command Line ##
+if __name__ == '__main__':
+
+    if len(sys.argv) != 4 or sys.argv[1] != "pack":
+        sys.stderr.write("Usage: {0} pack <static dir> <archive>\n".format(
+                                                                sys.argv[0]))
+        sys.exit(1)
+
+    count = pack_static(sys.argv[2], sys.argv[3])
+    print("{0} files packed into {1}".format(count, sys.argv[3]))